@@ -1,9 +1,35 @@
 import os
+import sys
 import shutil
 import re
 import json
+import heapq
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree
 import argparse
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+workerCollector = None    # collector object used by a worker process
+
+
+def init_worker(collector):
+    """
+    Store the collector object in a worker process of the pool.
+    """
+    global workerCollector
+    workerCollector = collector
+
+
+def process_file_in_worker(fname):
+    """
+    Process one corpus file in a worker process of the pool.
+    """
+    return workerCollector.process_file(fname)
 
 
 class GlossCollector:
@@ -12,18 +38,28 @@ class GlossCollector:
     a corpus. Different file types are processed by different subclasses.
     """
     rxBadGlosses = re.compile('^(?:I|[0-9]{2,})$')
+    rxTagSplit = re.compile('[/.]')
 
     def __init__(self, posTierType='', glossTierType='',
-                 lang='', ext='', corpusDir='.'):
+                 lang='', ext='', corpusDir='.', nJobs=0, reportLimit=0,
+                 fastJson=False):
         self.posTierType = posTierType
         self.glossTierType = glossTierType
         self.lang = lang      # language name as in the settings files
-        self.posTags = {}     # POS tag -> frequency
-        self.glosses = {}     # gloss -> frequency
+        self.posTags = Counter()     # POS tag -> frequency
+        self.glosses = Counter()     # gloss -> frequency
         self.ext = ext        # file extension for corpus files
         if len(ext) > 0 and not ext.startswith('.'):
             ext = '.' + ext
         self.corpusDir = corpusDir
+        self.nJobs = nJobs    # number of worker processes, 0 means number of CPU cores
+        if self.nJobs <= 0:
+            self.nJobs = os.cpu_count() or 1
+        self.reportLimit = reportLimit    # max number of rows per table in the report, 0 means no limit
+        self.fastJson = fastJson    # write JSON settings files with orjson
+        if self.fastJson and orjson is None:
+            print('orjson is not installed, JSON files will be written with the json module.')
+            self.fastJson = False
         self.tags2cat = {}
         fIn = open('data/common_gramm_tags.json', 'r', encoding='utf-8')
         self.tags2cat = json.load(fIn)
@@ -35,7 +71,7 @@ class GlossCollector:
         together with their frequencies.
         Implemented in subclasses.
         """
-        return {}
+        return Counter()
 
     def get_pos_tags(self, data):
         """
@@ -43,7 +79,26 @@ class GlossCollector:
         together with their frequencies.
         Implemented in subclasses.
         """
-        return {}
+        return Counter()
+
+    def get_annotations(self, data):
+        """
+        Return POS tags and glosses extracted from the contents of one
+        file (data) together with their frequencies, as a tuple of two
+        dictionaries. Subclasses may override this to collect both
+        in one pass over the data.
+        """
+        return self.get_pos_tags(data), self.get_glosses(data)
+
+    def get_file_annotations(self, fname):
+        """
+        Return POS tags and glosses found in one corpus file together
+        with their frequencies. By default, the file is loaded entirely
+        and passed to get_annotations(). Subclasses may override this
+        to read large files incrementally.
+        """
+        data = self.load_file(fname)
+        return self.get_annotations(data)
 
     def load_file(self, fname):
         """
@@ -57,41 +112,93 @@ class GlossCollector:
 
     def process_file(self, fname):
         """
-        Walk over the corpus directory, look into each suitable file
-        and add its glosses and POS tags to the list.
+        Return POS tags and glosses found in one corpus file together
+        with their frequencies. The collector itself is not modified,
+        so this can be run in a worker process.
         """
-        data = self.load_file(fname)
-        curPosTags = self.get_pos_tags(data)
-        for pos in curPosTags:
-            try:
-                self.posTags[pos] += curPosTags[pos]
-            except KeyError:
-                self.posTags[pos] = curPosTags[pos]
-        curGlosses = self.get_glosses(data)
-        for gloss in curGlosses:
-            try:
-                self.glosses[gloss] += curGlosses[gloss]
-            except KeyError:
-                self.glosses[gloss] = curGlosses[gloss]
+        return self.get_file_annotations(fname)
+
+    def add_annotations(self, curPosTags, curGlosses):
+        """
+        Add POS tags and glosses collected from one file
+        to the corpus-wide counters. Glosses that look like
+        something else (see rxBadGlosses) are skipped.
+        """
+        self.posTags.update(curPosTags)
+        glosses = self.glosses
+        matchBadGloss = self.rxBadGlosses.match
+        for gloss, freq in curGlosses.items():
+            if gloss not in glosses and matchBadGloss(gloss) is not None:
+                continue
+            glosses[gloss] += freq
+
+    def iter_corpus_files(self, dirname):
+        """
+        Recursively iterate over paths to all files with the corpus
+        file extension in a directory. As in os.walk(), symbolic links
+        to directories are not followed and unreadable directories
+        are skipped.
+        """
+        try:
+            entries = list(os.scandir(dirname))
+        except OSError:
+            return
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    yield from self.iter_corpus_files(entry.path)
+            elif entry.name.lower().endswith(self.ext):
+                yield entry.path
 
     def process_corpus(self):
         """
         Walk over the corpus directory, look into each suitable file
         and add information about its glosses and POS tags to the dictionaries.
         """
-        nFiles = 0
-        for root, dirs, files in os.walk(self.corpusDir):
-            for fname in files:
-                if not fname.lower().endswith(self.ext):
-                    continue
-                self.process_file(os.path.join(root, fname))
-                nFiles += 1
-        self.glosses = {gl: self.glosses[gl] for gl in self.glosses
-                        if self.rxBadGlosses.search(gl) is None}
+        fnames = list(self.iter_corpus_files(self.corpusDir))
+        nFiles = len(fnames)
+        if self.nJobs <= 1 or nFiles <= 1:
+            for fname in fnames:
+                self.add_annotations(*self.process_file(fname))
+        else:
+            with ProcessPoolExecutor(max_workers=self.nJobs,
+                                     initializer=init_worker,
+                                     initargs=(self,)) as executor:
+                for curPosTags, curGlosses in executor.map(process_file_in_worker,
+                                                           fnames, chunksize=8):
+                    self.add_annotations(curPosTags, curGlosses)
         print('Corpus processed, ' + str(nFiles) + ' files in total.')
         print(str(len(self.glosses)) + ' unique glosses, ' + str(len(self.posTags))
               + ' unique POS tags collected.')
 
+    def write_json(self, obj, fname):
+        """
+        Write a settings file in JSON with sorted keys. If fast JSON
+        output was requested, use orjson, which is much faster than the
+        json module on large gloss lists. Note that orjson only supports
+        2-space indentation, so the files are formatted differently.
+        """
+        if self.fastJson:
+            fOut = open(fname, 'wb')
+            fOut.write(orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2))
+            fOut.close()
+            return
+        fOut = open(fname, 'w', encoding='utf-8')
+        json.dump(obj, fOut, indent=4, ensure_ascii=False, sort_keys=True)
+        fOut.close()
+
+    def sort_by_frequency(self, freqs):
+        """
+        Return (tag, frequency) pairs from a frequency dictionary, sorted
+        by frequency in descending order and then alphabetically. If the
+        report is limited, only the most frequent pairs are selected,
+        without sorting the whole dictionary.
+        """
+        if 0 < self.reportLimit < len(freqs):
+            return heapq.nsmallest(self.reportLimit, freqs.items(),
+                                   key=lambda x: (-x[1], x[0]))
+        return sorted(freqs.items(), key=lambda x: (-x[1], x[0]))
+
     def prepare_settings_files(self):
         """
         After processing the corpus, generate the settings files
@@ -108,40 +215,41 @@ class GlossCollector:
             settings = json.load(fIn)
             fIn.close()
         settings['glosses'] = {self.lang: glossList}
-        fOut = open(convSettingsFname, 'w', encoding='utf-8')
-        json.dump(settings, fOut, indent=4, ensure_ascii=False, sort_keys=True)
-        fOut.close()
+        self.write_json(settings, convSettingsFname)
 
+        glossesLower = [gloss.lower() for gloss in glossList]
         fOut = open(os.path.join(self.corpusDir, 'grammRules.csv'), 'w', encoding='utf-8')
-        for gloss in glossList:
-            fOut.write(gloss + '\t' + gloss.lower().replace('.', ',') + '\n')
+        fOut.write(''.join(gloss + '\t' + glLower.replace('.', ',') + '\n'
+                           for gloss, glLower in zip(glossList, glossesLower)))
         fOut.close()
 
+        sortedGlosses = self.sort_by_frequency(self.glosses)
+        sortedPosTags = self.sort_by_frequency(self.posTags)
+        report = ['<html><head><title>Glosses and POS for ' + self.lang + '</title></head>\n<body>',
+                  '<h1>Glosses</h1>\n<table>']
+        report.extend('<tr><td>' + gloss + '</td><td>' + str(freq) + '</td></tr>\n'
+                      for gloss, freq in sortedGlosses)
+        report.append('</table>\n<h1>POS</h1>\n<table>')
+        report.extend('<tr><td>' + pos + '</td><td>' + str(freq) + '</td></tr>\n'
+                      for pos, freq in sortedPosTags)
         fOut = open(os.path.join(self.corpusDir, 'glosses.html'), 'w', encoding='utf-8')
-        fOut.write('<html><head><title>Glosses and POS for ' + self.lang + '</title></head>\n<body>')
-        fOut.write('<h1>Glosses</h1>\n<table>')
-        for gloss in sorted(self.glosses, key=lambda x: (-self.glosses[x], x)):
-            fOut.write('<tr><td>' + gloss + '</td><td>' + str(self.glosses[gloss]) + '</td></tr>\n')
-        fOut.write('</table>\n<h1>POS</h1>\n<table>')
-        for pos in sorted(self.posTags, key=lambda x: (-self.posTags[x], x)):
-            fOut.write('<tr><td>' + pos + '</td><td>' + str(self.posTags[pos]) + '</td></tr>\n')
+        fOut.write(''.join(report))
         fOut.close()
 
-        categories = {self.lang: {}}
-        for pos in self.posTags:
-            categories[self.lang][pos] = 'pos'
-        for gloss in glossList:
-            for tag in re.split('[/.]', gloss.lower()):
-                if tag in self.posTags:
-                    continue    # do not overwrite POS tags as they are more essential for the search
-                cat = 'add'
-                if tag in self.tags2cat:
-                    cat = self.tags2cat[tag]
-                categories[self.lang][tag] = cat
-
-        fOut = open(os.path.join(self.corpusDir, 'categories.json'), 'w', encoding='utf-8')
-        json.dump(categories, fOut, indent=4, ensure_ascii=False, sort_keys=True)
-        fOut.close()
+        posSet = frozenset(self.posTags)
+        tags2cat = self.tags2cat
+        categoriesLang = {pos: 'pos' for pos in posSet}
+        categories = {self.lang: categoriesLang}
+        # Many glosses share the same tags, so collect unique tags first
+        # and look up the category of each of them only once
+        glossTags = set()
+        for glLower in glossesLower:
+            glossTags.update(self.rxTagSplit.split(glLower))
+        glossTags -= posSet     # do not overwrite POS tags as they are more essential for the search
+        for tag in glossTags:
+            categoriesLang[tag] = tags2cat.get(tag, 'add')
+
+        self.write_json(categories, os.path.join(self.corpusDir, 'categories.json'))
 
         corpusSettings = {'lang_props': {self.lang:
                                              {'gloss_shortcuts': {},
@@ -162,58 +270,95 @@ class ISOTEIGlossCollector(GlossCollector):
     """
     namespaces = {'tei': 'http://www.tei-c.org/ns/1.0',
                   'xml': 'http://www.w3.org/XML/1998/namespace'}
+    xpAnnoBlocks = etree.XPath('/tei:TEI/tei:text/tei:body/tei:annotationBlock',
+                               namespaces=namespaces)
+    # Namespace-qualified tag names used in tree traversal
+    annoBlockTag = sys.intern('{' + namespaces['tei'] + '}annotationBlock')
+    bodyTag = sys.intern('{' + namespaces['tei'] + '}body')
+    spanGrpTag = sys.intern('{' + namespaces['tei'] + '}spanGrp')
+    spanTag = sys.intern('{' + namespaces['tei'] + '}span')
+
+    def process_anno_block(self, anno, curPOS, curGlosses):
+        """
+        Add POS tags and glosses found in one annotation block
+        to the counters curPOS and curGlosses.
+        """
+        # Local names are faster to look up than attributes in the loops below
+        posTierType = self.posTierType
+        glossTierType = self.glossTierType
+        spanTag = self.spanTag
+        posList = []
+        glossList = []
+        addPos = posList.append
+        addGloss = glossList.append
+        for tier in anno.iterchildren(self.spanGrpTag):
+            tierID = tier.get('type')
+            if tierID is None:
+                continue
+            if tierID == posTierType:
+                for wSpan in tier.iterchildren(spanTag):
+                    pos = wSpan.text
+                    if pos is not None and len(pos) > 0:
+                        addPos(pos)
+            if tierID == glossTierType:
+                for wSpan in tier.iterchildren(spanTag):
+                    for mSpan in wSpan.iterchildren(spanTag):
+                        gloss = mSpan.text
+                        if gloss is None or len(gloss) <= 0:
+                            continue
+                        # isupper() is enough for most glosses; the comparison is only
+                        # needed for glosses such as "3" or small capitals
+                        if not (gloss.isupper() or gloss.upper() == gloss):
+                            continue
+                        addGloss(gloss)
+        curPOS.update(posList)
+        curGlosses.update(glossList)
+
+    def get_annotations(self, data):
+        """
+        Return all POS tags and all glosses extracted from the contents
+        of one file (data) together with their frequencies. All annotation
+        blocks are traversed only once.
+        """
+        curPOS = Counter()
+        curGlosses = Counter()
+        for anno in self.xpAnnoBlocks(data):
+            self.process_anno_block(anno, curPOS, curGlosses)
+        return curPOS, curGlosses
+
+    def get_file_annotations(self, fname):
+        """
+        Return all POS tags and all glosses found in one corpus file
+        together with their frequencies. The file is parsed incrementally:
+        each annotation block is discarded as soon as it has been processed,
+        so that the whole tree is never kept in memory.
+        """
+        curPOS = Counter()
+        curGlosses = Counter()
+        for _, anno in etree.iterparse(fname, events=('end',), tag=self.annoBlockTag):
+            parent = anno.getparent()
+            if parent is None:
+                continue
+            if parent.tag == self.bodyTag:
+                self.process_anno_block(anno, curPOS, curGlosses)
+            anno.clear()
+            while anno.getprevious() is not None:
+                del parent[0]
+        return curPOS, curGlosses
 
     def get_glosses(self, data):
         """
         Return all glosses extracted from the contents of one file (data)
         together with their frequencies.
         """
-        curGlosses = {}
-        annotations = data.xpath('/tei:TEI/tei:text/tei:body/tei:annotationBlock',
-                                 namespaces=self.namespaces)
-        for anno in annotations:
-            for tier in anno.xpath('tei:spanGrp',
-                                   namespaces=self.namespaces):
-                if 'type' not in tier.attrib:
-                    continue
-                tierID = tier.attrib['type']
-                if tierID != self.glossTierType:
-                    continue
-                for wSpan in tier:
-                    for mSpan in wSpan:
-                        if mSpan.text is not None and len(mSpan.text) > 0 and mSpan.text.upper() == mSpan.text:
-                            gloss = mSpan.text
-                            try:
-                                curGlosses[gloss] += 1
-                            except KeyError:
-                                curGlosses[gloss] = 1
-        return curGlosses
+        return self.get_annotations(data)[1]
 
     def get_pos_tags(self, data):
         """
         Return all POS tags extracted from the contents of one file (data)
         together with their frequencies.
-        Implemented in subclasses.
         """
-        curPOS = {}
-        annotations = data.xpath('/tei:TEI/tei:text/tei:body/tei:annotationBlock',
-                                 namespaces=self.namespaces)
-        for anno in annotations:
-            for tier in anno.xpath('tei:spanGrp',
-                                   namespaces=self.namespaces):
-                if 'type' not in tier.attrib:
-                    continue
-                tierID = tier.attrib['type']
-                if tierID != self.posTierType:
-                    continue
-                for wSpan in tier:
-                    if wSpan.text is not None and len(wSpan.text) > 0:
-                        pos = wSpan.text
-                        try:
-                            curPOS[pos] += 1
-                        except KeyError:
-                            curPOS[pos] = 1
-        return curPOS
+        return self.get_annotations(data)[0]
 
     def load_file(self, fname):
         """
@@ -228,52 +373,91 @@ class ExmaraldaGlossCollector(GlossCollector):
     """
     A subclass of GlossCollector for Hamburg Exmaralda (exb) files.
     """
+    xpAnnoTiers = etree.XPath('/basic-transcription/basic-body/tier[@type=\'a\']')
+    glossSepTrans = str.maketrans('-=', '\x01\x01')   # gloss separators, see split_glosses()
+
+    def split_glosses(self, text):
+        """
+        Split a glossed word into separate glosses. Glosses are
+        separated by "-", "=" or ".[". The separators are mapped to
+        a control character first, which is cheaper than a regex split.
+        """
+        return text.replace('.[', '\x01').translate(self.glossSepTrans).split('\x01')
+
+    def process_tier(self, tier, curPOS, curGlosses):
+        """
+        Add POS tags and glosses found in one annotation tier
+        to the counters curPOS and curGlosses.
+        """
+        tierID = tier.get('category')
+        if tierID is None:
+            return
+        if tierID == self.posTierType:
+            posList = []
+            addPos = posList.append
+            for wSpan in tier.iterchildren('event'):
+                pos = wSpan.text
+                if pos is not None and len(pos) > 0:
+                    addPos(pos)
+            curPOS.update(posList)
+        if tierID == self.glossTierType:
+            glossList = []
+            addGloss = glossList.append
+            splitGlosses = self.split_glosses
+            for wSpan in tier.iterchildren('event'):
+                text = wSpan.text
+                if text is not None and len(text) > 0:
+                    for gloss in splitGlosses(text):
+                        gloss = gloss.strip('[]()<>')
+                        if not (gloss.isupper() or gloss.upper() == gloss):
+                            continue
+                        addGloss(gloss)
+            curGlosses.update(glossList)
+
+    def get_annotations(self, data):
+        """
+        Return all POS tags and all glosses extracted from the contents
+        of one file (data) together with their frequencies. All annotation
+        tiers are traversed only once.
+        """
+        curPOS = Counter()
+        curGlosses = Counter()
+        for tier in self.xpAnnoTiers(data):
+            self.process_tier(tier, curPOS, curGlosses)
+        return curPOS, curGlosses
+
+    def get_file_annotations(self, fname):
+        """
+        Return all POS tags and all glosses found in one corpus file
+        together with their frequencies. The file is parsed incrementally:
+        each tier is discarded as soon as it has been processed.
+        """
+        curPOS = Counter()
+        curGlosses = Counter()
+        for _, tier in etree.iterparse(fname, events=('end',), tag='tier'):
+            parent = tier.getparent()
+            if parent is None:
+                continue
+            if parent.tag == 'basic-body' and tier.get('type') == 'a':
+                self.process_tier(tier, curPOS, curGlosses)
+            tier.clear()
+            while tier.getprevious() is not None:
+                del parent[0]
+        return curPOS, curGlosses
 
     def get_glosses(self, data):
         """
         Return all glosses extracted from the contents of one file (data)
         together with their frequencies.
         """
-        curGlosses = {}
-        for tier in data.xpath('/basic-transcription/basic-body/tier[@type=\'a\']'):
-            if 'category' not in tier.attrib:
-                continue
-            tierID = tier.attrib['category']
-            if tierID != self.glossTierType:
-                continue
-            for wSpan in tier:
-                if wSpan.text is not None and len(wSpan.text) > 0:
-                    for gloss in re.split('[-=]|\\.\\[', wSpan.text):
-                        gloss = gloss.strip('[]()<>')
-                        if gloss != gloss.upper():
-                            continue
-                        try:
-                            curGlosses[gloss] += 1
-                        except KeyError:
-                            curGlosses[gloss] = 1
-        return curGlosses
+        return self.get_annotations(data)[1]
 
     def get_pos_tags(self, data):
         """
         Return all POS tags extracted from the contents of one file (data)
         together with their frequencies.
-        Implemented in subclasses.
         """
-        curPOS = {}
-        for tier in data.xpath('/basic-transcription/basic-body/tier[@type=\'a\']'):
-            if 'category' not in tier.attrib:
-                continue
-            tierID = tier.attrib['category']
-            if tierID != self.posTierType:
-                continue
-            for wSpan in tier:
-                if wSpan.text is not None and len(wSpan.text) > 0:
-                    pos = wSpan.text
-                    try:
-                        curPOS[pos] += 1
-                    except KeyError:
-                        curPOS[pos] = 1
-        return curPOS
+        return self.get_annotations(data)[0]
 
     def load_file(self, fname):
         """
@@ -294,13 +478,9 @@ class UniparserGlossCollector(GlossCollector):
         Return all glosses extracted from the gloss field with
         dummy frequencies.
         """
-        curGlosses = {}
+        curGlosses = Counter()
         for glossSet in re.findall('gloss: *([^\r\n]+)', data):
-            for gloss in glossSet.split('|'):
-                if gloss not in curGlosses:
-                    curGlosses[gloss] = 1
-                else:
-                    curGlosses[gloss] += 1
+            curGlosses.update(glossSet.split('|'))
         return curGlosses
 
     def get_pos_tags(self, data):
@@ -308,13 +488,9 @@ class UniparserGlossCollector(GlossCollector):
         Return all POS / gramm tags extracted from the gramm field
         with dummy frequencies.
         """
-        curPOS = {}
+        curPOS = Counter()
         for grammSet in re.findall('gramm: *([^\r\n]+)', data):
-            for gramm in grammSet.split(','):
-                if gramm not in curPOS:
-                    curPOS[gramm] = 1
-                else:
-                    curPOS[gramm] += 1
+            curPOS.update(grammSet.split(','))
         return curPOS
 
     def load_file(self, fname):
@@ -341,27 +517,44 @@ if __name__ == '__main__':
                         default='ps')
     parser.add_argument('--gloss', help='Gloss tier type',
                         default='ge')
+    parser.add_argument('-j', '--jobs', help='Number of worker processes (0 = number of CPU cores)',
+                        type=int, default=0)
+    parser.add_argument('--report-limit', help='Maximum number of glosses / POS tags'
+                                               ' shown in the report (0 = no limit)',
+                        type=int, default=0)
+    parser.add_argument('--fast-json', help='Write JSON settings files with orjson'
+                                            ' (faster, but with 2-space indentation)',
+                        action='store_true')
     args = parser.parse_args()
     if args.format == 'tei':
         gc = ISOTEIGlossCollector(posTierType=args.pos,
                                   glossTierType=args.gloss,
                                   lang=args.lang,
                                   corpusDir=args.dir,
-                                  ext='xml')
+                                  ext='xml',
+                                  nJobs=args.jobs,
+                                  reportLimit=args.report_limit,
+                                  fastJson=args.fast_json)
         gc.run()
     elif args.format == 'exb':
         gc = ExmaraldaGlossCollector(posTierType=args.pos,
                                      glossTierType=args.gloss,
                                      lang=args.lang,
                                      corpusDir=args.dir,
-                                     ext='exb')
+                                     ext='exb',
+                                     nJobs=args.jobs,
+                                     reportLimit=args.report_limit,
+                                     fastJson=args.fast_json)
         gc.run()
     elif args.format == 'uniparser':
         gc = UniparserGlossCollector(posTierType='',
                                      glossTierType='',
                                      lang=args.lang,
                                      corpusDir=args.dir,
-                                     ext='txt')
+                                     ext='txt',
+                                     nJobs=args.jobs,
+                                     reportLimit=args.report_limit,
+                                     fastJson=args.fast_json)
         gc.run()
     else:
         print('Only ISO/TEI xml, EXMARaLDA exb and UniParser grammars are supported at the moment.')
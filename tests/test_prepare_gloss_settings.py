@@ -0,0 +1,83 @@
+import os
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from prepare_gloss_settings import ISOTEIGlossCollector, ExmaraldaGlossCollector
+
+
+class GlossCollectorTestCase(unittest.TestCase):
+    """
+    Base class for collector tests: the collectors read
+    data/common_gramm_tags.json relative to the working directory.
+    """
+
+    def setUp(self):
+        self.oldDir = os.getcwd()
+        os.chdir(REPO_DIR)
+        self.tmpDir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+        os.chdir(self.oldDir)
+
+    def write_file(self, fname, text):
+        fname = os.path.join(self.tmpDir.name, fname)
+        with open(fname, 'w', encoding='utf-8') as fOut:
+            fOut.write(text)
+        return fname
+
+
+class ISOTEIGlossCollectorTest(GlossCollectorTestCase):
+    teiTemplate = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body>'
+                   '<annotationBlock>'
+                   '<spanGrp type="ps"><span>n</span></spanGrp>'
+                   '<spanGrp type="ge"><span>{}</span></spanGrp>'
+                   '</annotationBlock>'
+                   '</body></text></TEI>')
+
+    def get_glosses(self, *morphs):
+        gc = ISOTEIGlossCollector(posTierType='ps', glossTierType='ge')
+        wSpan = ''.join('<span>' + m + '</span>' for m in morphs)
+        fname = self.write_file('test.xml', self.teiTemplate.format(wSpan))
+        curPosTags, curGlosses = gc.process_file(fname)
+        return curGlosses
+
+    def test_uppercase_glosses(self):
+        self.assertEqual(self.get_glosses('house', 'NOM.SG', '3', 'Pl'),
+                         {'NOM.SG': 1, '3': 1})
+
+    def test_small_capital_glosses(self):
+        self.assertEqual(self.get_glosses('dom', 'ᴘʟ', 'ɢᴇɴ'),
+                         {'ᴘʟ': 1, 'ɢᴇɴ': 1})
+
+
+class ExmaraldaGlossCollectorTest(GlossCollectorTestCase):
+    exbTemplate = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<basic-transcription><head/><basic-body><common-timeline/>'
+                   '<tier id="t1" category="ps" type="a"><event start="T0" end="T1">n</event></tier>'
+                   '<tier id="t2" category="ge" type="a"><event start="T0" end="T1">{}</event></tier>'
+                   '</basic-body></basic-transcription>')
+
+    def get_glosses(self, glossedWord):
+        gc = ExmaraldaGlossCollector(posTierType='ps', glossTierType='ge')
+        fname = self.write_file('test.exb', self.exbTemplate.format(glossedWord))
+        curPosTags, curGlosses = gc.process_file(fname)
+        return curGlosses
+
+    def test_uppercase_glosses(self):
+        self.assertEqual(self.get_glosses('house-NOM.SG=3SG.[PL]'),
+                         {'NOM.SG': 1, '3SG': 1, 'PL': 1})
+
+    def test_small_capital_glosses(self):
+        # Small capitals have no uppercase form, so islower() is true for them
+        self.assertEqual(self.get_glosses('dom-ᴘʟ-ɢᴇɴ'),
+                         {'ᴘʟ': 1, 'ɢᴇɴ': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()